@@ -0,0 +1,22 @@
+import json
+import sys
+
+import pdfplumber
+
+
+# Page parsing for sheet.py, run as a fresh interpreter per chunk of pages so that no
+# worker is ever forked from the threaded Streamlit server
+def extract_page_tables(pdf_path, page_indices):
+    """Raw tables for each page index"""
+    results = []
+    with pdfplumber.open(pdf_path) as pdf:
+        for i in page_indices:
+            page = pdf.pages[i]
+            results.append(page.extract_tables())
+            page.close()
+    return results
+
+
+if __name__ == "__main__":
+    # Arguments: the PDF path, then the page indices; the tables go to stdout as JSON
+    json.dump(extract_page_tables(sys.argv[1], [int(i) for i in sys.argv[2:]]), sys.stdout)
@@ -2,16 +2,166 @@ import streamlit as st
 import pandas as pd
 import pdfplumber
 import re
+import asyncio
+import gzip
+import hashlib
+import importlib.util
+import json
+import sqlite3
 from io import BytesIO
 import openpyxl
+import xlsxwriter
 import time
 from datetime import datetime
 import threading
+import os
+import subprocess
+import sys
+import tempfile
+import zlib
 from functools import lru_cache
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import numpy as np
 import google.generativeai as genai
 
+# PDFium (optional) spots text-less, scanned pages so pdfminer never parses them
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# PyMuPDF (optional, not in requirements) finds tables in C; pdfplumber covers the rest
+try:
+    import pymupdf
+except ImportError:
+    try:
+        import fitz as pymupdf
+    except ImportError:
+        pymupdf = None
+
+# Previews are read with the Rust calamine reader when python-calamine is installed
+_EXCEL_READ_ENGINE = "calamine" if importlib.util.find_spec("python_calamine") else None
+
+# Divisors for each target unit
+_FACTORS = {
+    "Hundred": 100,
+    "Thousand": 1000,
+    "Lakhs": 100000,
+    "Crore": 10000000
+}
+
+# PDF pages are parsed in worker processes once there are enough to amortize start-up;
+# each worker is a fresh interpreter running pdf_worker.py, given up on after the timeout
+_PDF_WORKERS = os.cpu_count() or 1
+_PDF_PARALLEL_MIN_PAGES = 4
+_PDF_WORKER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pdf_worker.py')
+_PDF_WORKER_TIMEOUT = 600
+
+# Raw page tables are kept on disk by content hash, so re-uploads skip parsing
+# across sessions; an empty PDF_CACHE_DIR turns this off
+_PDF_CACHE_DIR = os.environ.get(
+    'PDF_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'balance_sheet', 'pdf')
+)
+# Entries unused for a week are dropped, then the least recently used ones until
+# the directory fits the size cap
+_PDF_CACHE_MAX_AGE = 7 * 24 * 3600
+_PDF_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+# Previews show a few rows; expanding one never sends more than this many to the browser
+_PREVIEW_MAX_ROWS = 1000
+
+# Each cached result holds whole workbooks or tables, so only the most recent few are kept
+_CACHE_MAX_ENTRIES = 8
+
+# Progress bar updates: at most one per 5% of the work, or per second when slower
+_PROGRESS_STEP = 0.05
+_PROGRESS_INTERVAL = 1.0
+
+# Gemini requests in flight at once, and how many extractions are memoized
+_GEMINI_CONCURRENCY = 8
+_GEMINI_CACHE_SIZE = 1000
+_gemini_cache = {}
+_gemini_loop = None
+
+# Gemini responses are also kept on disk so reruns and re-uploads skip the API;
+# bump the prompt version whenever the prompt changes
+_GEMINI_MODEL = 'gemini-2.0-flash'
+_GEMINI_PROMPT_VERSION = 'v1'
+_GEMINI_CACHE_PATH = os.environ.get(
+    'GEMINI_CACHE_PATH', os.path.join(os.path.expanduser('~'), '.cache', 'balance_sheet', 'gemini.sqlite')
+)
+
+# Pattern sources; every compiled variant below is derived from these so the
+# classifier, the single-cell converter and the vectorized path agree
+_NUMBER_PATTERN = r'-?\d{1,3}(?:,\d{3})*(?:\.\d{1,2})?'
+_YEAR_PATTERN = r'\d{4}'
+_FY_PATTERN = r'FY\d{4}|\d{4}-\d{2}'
+_DAY_SUFFIX_PATTERN = r'\d{1,2}(?:st|nd|rd|th)'
+_DOTTED_DATE_PATTERN = r'\d{1,2}\.\d{1,2}\.\d{4}'  # 31.03.2025
+
+# Precompiled patterns shared by the per-cell hot paths
+_NUMBER_RE = re.compile(_NUMBER_PATTERN)
+_SIMPLE_NUMBER_RE = re.compile(f'^{_NUMBER_PATTERN}$')
+_HAS_DIGIT_RE = re.compile(r'\d')
+# Figures stated with a scale word ("25 lakh", "2.5 mn") cannot be scaled digit by
+# digit; with an API key Gemini reads them and each figure is rewritten in place
+_SCALE_AMOUNT_RE = re.compile(
+    r'(?<![\w.])-?\d[\d,]*(?:\.\d+)?\s*(?:hundreds?|thousands?|lakhs?|lacs?|crores?|millions?|mn|billions?|bn)\b',
+    re.IGNORECASE
+)
+# Everything that is not part of a number, stripped from Gemini's answers
+_NON_NUMERIC_RE = re.compile(r'[^\d.-]')
+_DATE_RES = [re.compile(p, re.IGNORECASE) for p in (
+    r'\d{1,2}[-/\.]\d{1,2}[-/\.]\d{2,4}',  # DD-MM-YYYY, DD/MM/YYYY, DD.MM.YYYY
+    r'\d{4}[-/\.]\d{1,2}[-/\.]\d{1,2}',    # YYYY-MM-DD, YYYY/MM/DD, YYYY.MM.DD
+    r'(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]* \d{1,2},? \d{4}',
+    r'\d{1,2}(st|nd|rd|th) (jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]* \d{4}',
+    _DOTTED_DATE_PATTERN,
+    r'as at \d{1,2}[-/\.]\d{1,2}[-/\.]\d{4}',  # "as at 31.03.2025"
+    r'closing.*\d{4}',  # "Closing WDV as at 2025"
+)]
+# Substring phrases that mark a cell with digits as a date/period description
+_DATE_PHRASES = (
+    'as at', 'at', 'on', 'date', 'year', 'period', 'closing',
+    'opening', 'beginning', 'end', 'financial year', 'fy'
+)
+_OTHER_ID_PATTERNS = (
+    r'[A-Z]{1}[0-9]{5}[A-Z]{2}[0-9]{4}[A-Z]{3}[0-9]{6}',  # CIN
+    r'[A-Z]{3}[0-9]{5}',  # DIN-like
+    r'[+]{0,1}[0-9]{2,4}[- ]{0,1}[0-9]{3}[- ]{0,1}[0-9]{3}[- ]{0,1}[0-9]{4}',  # Phone
+    r'(mem|firm|reg|id|no)[\. ]*\d+',  # MEM NO., FIRM NO., etc.
+)
+_DAYS_MONTHS = frozenset((
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    "january", "february", "march", "april", "may", "june", "july", "august",
+    "september", "october", "november", "december", "jan", "feb", "mar", "apr",
+    "jun", "jul", "aug", "sep", "oct", "nov", "dec"
+))
+# is_non_monetary_content: every whole-cell check (formula, year, FY, day suffix,
+# "as <number>") folded into one anchored union, tried once at the start of the cell
+_NON_MONETARY_CELL_RE = re.compile('|'.join(f'(?:{p})' for p in (
+    r'\s*=',  # formula
+    f'(?:{_YEAR_PATTERN}|{_FY_PATTERN}|{_DAY_SUFFIX_PATTERN})$',  # 2025, FY2025, 2024-25, 31st
+    r'(?=[\s\S]*(?<!\S)as(?!\S))(?=[\s\S]*(?<!\S)\d+(?!\S))',  # the word "as" next to a number
+)), re.IGNORECASE)
+_DATE_RE = re.compile('|'.join(f'(?:{pattern.pattern})' for pattern in _DATE_RES), re.IGNORECASE)
+_DATE_PHRASE_RE = re.compile('|'.join(re.escape(phrase) for phrase in _DATE_PHRASES))
+_OTHER_ID_RE = re.compile('|'.join(f'(?:{p})' for p in _OTHER_ID_PATTERNS), re.IGNORECASE)
+# Text cells with at least this many numbers are rewritten through NumPy
+_NUMPY_MIN_NUMBERS = 16
+# Whole-cell numbers with Western (1,500,000) or Indian (15,00,000) grouping
+_PLAIN_NUMBER_RE = re.compile(r'-?(?:\d{1,3}(?:,\d{2,3})+|\d+)(?:\.\d+)?')
+# Whole-cell values that must never be converted: years, FY, day suffixes, dates, day/month names.
+# Longer cells go straight to is_non_monetary_content, which covers the same patterns
+_EXCLUDE_MAX_LEN = 30
+_EXCLUDE_RE = re.compile('|'.join(f'(?:{p})' for p in (
+    _YEAR_PATTERN,
+    _FY_PATTERN,
+    _DAY_SUFFIX_PATTERN,
+    *(pattern.pattern for pattern in _DATE_RES),
+    '|'.join(sorted(_DAYS_MONTHS, key=len, reverse=True)),
+)), re.IGNORECASE)
+
 # Set up Gemini API
 def setup_gemini(api_key):
     try:
@@ -30,223 +180,297 @@ def is_non_monetary_content(text):
     if not isinstance(text, str) or not text.strip():
         return False
     
-    text_lower = text.lower().strip()
-    
-    # Quick checks first - formulas
-    if text_lower.startswith('='):
-        return True
+    # Without a digit only formulas and bare day/month names are non-monetary
+    if not _HAS_DIGIT_RE.search(text):
+        stripped = text.strip()
+        return stripped.startswith('=') or stripped.lower() in _DAYS_MONTHS
     
-    # Check if it's purely a year (like 2025, 2024, etc.)
-    if re.match(r'^\d{4}$', text):
-        return True
-    
-    # Check if it's a financial year pattern (FY2025, 2024-25, etc.)
-    if re.match(r'^(FY\d{4}|\d{4}-\d{2})$', text, re.IGNORECASE):
-        return True
-    
-    # Check for simple numeric patterns that don't need Gemini
-    # Allow decimal numbers with proper formatting
-    if re.match(r'^-?\d{1,3}(?:,\d{3})*(?:\.\d{1,2})?$', text):
-        # But exclude dates that look like numbers (like 31.03.2025)
-        if re.search(r'\d{1,2}\.\d{1,2}\.\d{4}', text):
-            return True
+    # Plain numbers (1,234.50) are monetary and can't match any pattern below
+    if _SIMPLE_NUMBER_RE.match(text):
         return False
     
-    # Date patterns - IMPROVED
-    date_patterns = [
-        r'\d{1,2}[-/\.]\d{1,2}[-/\.]\d{2,4}',  # DD-MM-YYYY, DD/MM/YYYY, DD.MM.YYYY
-        r'\d{4}[-/\.]\d{1,2}[-/\.]\d{1,2}',    # YYYY-MM-DD, YYYY/MM/DD, YYYY.MM.DD
-        r'(jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]* \d{1,2},? \d{4}',
-        r'\d{1,2}(st|nd|rd|th) (jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)[a-z]* \d{4}',
-        r'\d{1,2}\.\d{1,2}\.\d{4}',  # Specific pattern for 31.03.2025
-        r'as at \d{1,2}[-/\.]\d{1,2}[-/\.]\d{4}',  # "as at 31.03.2025"
-        r'closing.*\d{4}',  # "Closing WDV as at 2025"
-    ]
+    # Whole-cell patterns, then date phrases, dates and CIN/DIN/phone/MEM NO. anywhere
+    return bool(
+        _NON_MONETARY_CELL_RE.match(text)
+        or _DATE_PHRASE_RE.search(text.lower())
+        or _DATE_RE.search(text)
+        or _OTHER_ID_RE.search(text)
+    )
+
+# Cache Gemini responses
+class GeminiCacheMiss(LookupError):
+    """Raised in replay mode when a text has no stored Gemini response"""
+
+class GeminiCache:
+    """Persistent sqlite store of Gemini extractions; mode is 'enabled', 'replay' or 'disabled'"""
     
-    for pattern in date_patterns:
-        if re.search(pattern, text, re.IGNORECASE):
-            return True
+    def __init__(self, path, mode='enabled'):
+        self.path = path
+        self.mode = mode
+        self._conn = None
+        self._lock = threading.Lock()
     
-    # Check for date-like phrases
-    date_phrases = [
-        'as at', 'at', 'on', 'date', 'year', 'period', 'closing',
-        'opening', 'beginning', 'end', 'financial year', 'fy'
-    ]
+    def _connection(self):
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, response TEXT, ts REAL)'
+            )
+        return self._conn
     
-    if any(phrase in text_lower for phrase in date_phrases) and any(char.isdigit() for char in text):
-        return True
+    @staticmethod
+    def key(text):
+        return hashlib.sha256(f"{text}|{_GEMINI_MODEL}|{_GEMINI_PROMPT_VERSION}".encode()).hexdigest()
     
-    # Other patterns
-    patterns = [
-        r'[A-Z]{1}[0-9]{5}[A-Z]{2}[0-9]{4}[A-Z]{3}[0-9]{6}',  # CIN
-        r'[A-Z]{3}[0-9]{5}',  # DIN-like
-        r'[+]{0,1}[0-9]{2,4}[- ]{0,1}[0-9]{3}[- ]{0,1}[0-9]{3}[- ]{0,1}[0-9]{4}',  # Phone
-        r'^\d{1,2}(st|nd|rd|th)$',  # Day suffix
-        r'(mem|firm|reg|id|no)[\. ]*\d+',  # MEM NO., FIRM NO., etc.
-    ]
+    def get(self, text):
+        """Stored numbers for text, or None on a miss"""
+        if self.mode == 'disabled':
+            return None
+        try:
+            with self._lock:
+                row = self._connection().execute(
+                    'SELECT response FROM cache WHERE key=?', (self.key(text),)
+                ).fetchone()
+        except (sqlite3.Error, OSError) as e:
+            print(f"Gemini cache error: {e}")
+            row = None
+        if row is None:
+            if self.mode == 'replay':
+                raise GeminiCacheMiss(text)
+            return None
+        return json.loads(row[0])
     
-    for pattern in patterns:
-        if re.search(pattern, text, re.IGNORECASE):
-            return True
+    def put(self, text, numbers):
+        if self.mode != 'enabled':
+            return
+        try:
+            with self._lock, self._connection() as conn:
+                conn.execute(
+                    'INSERT OR REPLACE INTO cache (key, response, ts) VALUES (?, ?, ?)',
+                    (self.key(text), json.dumps(numbers), time.time())
+                )
+        except (sqlite3.Error, OSError) as e:
+            print(f"Gemini cache error: {e}")
+
+gemini_disk_cache = GeminiCache(_GEMINI_CACHE_PATH)
+
+_GEMINI_PROMPT = """Extract only monetary values from this text: "{text}". 
+        Return only the numbers separated by commas. 
+        Ignore dates, years, phone numbers, IDs, and other non-monetary values.
+        Example: "Closing balance as at 31.03.2025 is 1,50,000" should return "150000"
+        Example: "Year 2025 revenue" should return nothing"""
+
+@lru_cache(maxsize=1)
+def _get_model(api_key):
+    """Gemini model configured for api_key, built once and reused across batches"""
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(_GEMINI_MODEL)
+
+def _gemini_event_loop():
+    """One event loop for all batches, so the model's async client is never tied to a closed loop"""
+    global _gemini_loop
+    if _gemini_loop is None or _gemini_loop.is_closed():
+        _gemini_loop = asyncio.new_event_loop()
+    return _gemini_loop
+
+def _parse_gemini_numbers(response):
+    """Pull the comma-separated numbers out of a Gemini response"""
+    numbers = []
+    if response and response.text:
+        numbers_text = response.text.strip()
+        for part in numbers_text.split(','):
+            clean_part = _NON_NUMERIC_RE.sub('', part.strip())
+            if clean_part and clean_part.replace('.', '', 1).replace('-', '', 1).isdigit():
+                numbers.append(float(clean_part))
+    return numbers
+
+def _needs_gemini(text):
+    """Whether a text's amount is beyond the regex: a figure with a scale word, or digits \\d doesn't cover (²)"""
+    # Text without any digit (unit headers such as "(Amount in Lakhs)") never leaves the app
+    if not isinstance(text, str) or not any(char.isdigit() for char in text) or is_non_monetary_content(text):
+        return False
+    return bool(_SCALE_AMOUNT_RE.search(text)) or not _NUMBER_RE.search(text.replace(',', ''))
+
+async def _gemini_batch(texts, api_key):
+    """Send all prompts concurrently, at most _GEMINI_CONCURRENCY in flight"""
+    model = _get_model(api_key)
+    semaphore = asyncio.Semaphore(_GEMINI_CONCURRENCY)
     
-    # Days and months
-    days_months = [
-        "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
-        "january", "february", "march", "april", "may", "june", "july", "august",
-        "september", "october", "november", "december", "jan", "feb", "mar", "apr",
-        "may", "jun", "jul", "aug", "sep", "oct", "nov", "dec"
-    ]
+    async def extract(text):
+        async with semaphore:
+            return _parse_gemini_numbers(await model.generate_content_async(_GEMINI_PROMPT.format(text=text)))
     
-    if text_lower in days_months:
-        return True
+    return await asyncio.gather(*(extract(text) for text in texts), return_exceptions=True)
+
+def gemini_extract_batch(texts, api_key):
+    """Extract monetary values for many texts at once; returns {text: numbers}"""
+    unique = list(dict.fromkeys(text for text in texts if _needs_gemini(text)))
+    found = {text: _gemini_cache[(text, api_key)] for text in unique if (text, api_key) in _gemini_cache}
+    pending = []
+    for text in unique:
+        if text in found:
+            continue
+        numbers = gemini_disk_cache.get(text)
+        if numbers is None:
+            pending.append(text)
+        else:
+            _gemini_cache[(text, api_key)] = found[text] = numbers
+    if not pending:
+        return found
     
-    # Check for text that contains both words and numbers but is not monetary
-    words = text_lower.split()
-    if len(words) > 1 and any(word.isalpha() for word in words) and any(word.isdigit() for word in words):
-        # If it contains date-related words with numbers, preserve it
-        date_related_words = ['year', 'date', 'period', 'closing', 'opening', 'as', 'at', 'on']
-        if any(word in date_related_words for word in words):
-            return True
+    try:
+        responses = _gemini_event_loop().run_until_complete(_gemini_batch(pending, api_key))
+    except Exception as e:
+        print(f"Gemini API error: {e}")
+        return found
     
-    return False
+    for text, numbers in zip(pending, responses):
+        if isinstance(numbers, BaseException):
+            print(f"Gemini API error: {numbers}")
+            continue
+        if len(_gemini_cache) >= _GEMINI_CACHE_SIZE:
+            _gemini_cache.pop(next(iter(_gemini_cache)))
+        _gemini_cache[(text, api_key)] = found[text] = numbers
+        gemini_disk_cache.put(text, numbers)
+    return found
 
-# Cache Gemini responses
-@lru_cache(maxsize=1000)
 def cached_gemini_extraction(text, api_key):
     """Cached version of Gemini extraction"""
-    if not text or not any(char.isdigit() for char in str(text)):
-        return []
+    return gemini_extract_batch([text], api_key).get(text, [])
+
+# Batch processing function - UPDATED
+# Memoized: the same labels, totals and footers recur across rows and sheets
+@lru_cache(maxsize=8192)
+def _rewrite_numbers(val, factor, threshold):
+    """Replace the numbers above threshold in a text cell; None if the text holds no number"""
+    # Quick regex extraction
+    num_matches = _NUMBER_RE.findall(val.replace(',', ''))
+    if not num_matches:
+        return None
+    numbers = [float(match) for match in num_matches]
     
-    # Skip if it's clearly non-monetary content
-    if is_non_monetary_content(text):
-        return []
+    # Check if this might be a date disguised as numbers
+    if len(numbers) == 3 and all(0 < num < 32 for num in numbers[:2]) and numbers[2] > 1900:
+        return val
     
-    try:
-        genai.configure(api_key=api_key)
-        model = genai.GenerativeModel('gemini-2.0-flash')
-        
-        prompt = f"""Extract only monetary values from this text: "{text}". 
-        Return only the numbers separated by commas. 
-        Ignore dates, years, phone numbers, IDs, and other non-monetary values.
-        Example: "Closing balance as at 31.03.2025 is 1,50,000" should return "150000"
-        Example: "Year 2025 revenue" should return nothing"""
-        
-        response = model.generate_content(prompt)
-        
-        if response and response.text:
-            numbers_text = response.text.strip()
-            numbers = []
-            for part in numbers_text.split(','):
-                clean_part = re.sub(r'[^\d.-]', '', part.strip())
-                if clean_part and clean_part.replace('.', '', 1).replace('-', '', 1).isdigit():
-                    numbers.append(float(clean_part))
-            return numbers
-    except Exception as e:
-        print(f"Gemini API error: {e}")
-        pass
+    if len(numbers) >= _NUMPY_MIN_NUMBERS:
+        # Cells listing many figures: select and scale them in one NumPy pass
+        arr = np.asarray(numbers, dtype=np.float64)
+        big = arr[np.abs(arr) > threshold]
+        replacements = dict(zip(map(str, big.tolist()), map(str, _scale_values(big, factor))))
+    else:
+        replacements = {}
+        for num in numbers:
+            if abs(num) > threshold:
+                converted = num / factor
+                replacements[str(num)] = str(int(converted) if converted.is_integer() else round(converted, 2))
+    if not replacements:
+        return val
     
-    return []
+    # One left-to-right pass, longest key first at each position, so a replaced
+    # number is never matched again by a shorter key
+    keys = sorted(replacements, key=len, reverse=True)
+    return re.sub('|'.join(map(re.escape, keys)), lambda m: replacements[m.group(0)], val)
 
-# Batch processing function - UPDATED
-def process_cell_batch(cell_values, conversion_unit, threshold, api_key=None):
-    """Process a batch of cells efficiently"""
-    results = []
-    conversion_factors = {
-        "Hundred": 100,
-        "Thousand": 1000,
-        "Lakhs": 100000,
-        "Crore": 10000000
-    }
-    factor = conversion_factors[conversion_unit]
-    
-    for val in cell_values:
-        try:
-            # Skip processing for non-monetary content - CHECK FIRST
-            if isinstance(val, str) and is_non_monetary_content(val):
-                results.append(val)
-                continue
+def _convert_text_value(val, factor, threshold, api_key=None, llm_numbers=None):
+    """Convert the numbers embedded in a single text cell"""
+    # Use Gemini only for complex cases; without an answer the regex path still applies
+    if api_key and _needs_gemini(val):
+        if llm_numbers is not None:
+            numbers = llm_numbers.get(val, [])
+        else:
+            numbers = cached_gemini_extraction(val, api_key)
+        amounts = _SCALE_AMOUNT_RE.findall(val)
+        if amounts and len(amounts) == len(numbers):
+            # One answer per scale-word figure: each figure is replaced where it stands,
+            # so the rest of the label survives
+            answers = iter(numbers)
             
-            # Handle numeric values quickly
-            if isinstance(val, (int, float)):
-                if abs(val) > threshold:
-                    converted = val / factor
-                    results.append(int(converted) if converted.is_integer() else round(converted, 2))
-                else:
-                    results.append(val)
-                continue
+            def replace(match):
+                num = next(answers)
+                if abs(num) <= threshold:
+                    return match.group(0)
+                converted = num / factor
+                return str(int(converted) if converted.is_integer() else round(converted, 2))
             
-            # Handle string values
-            if isinstance(val, str):
-                # Quick regex extraction for simple cases
-                num_matches = re.findall(r'-?\d{1,3}(?:,\d{3})*(?:\.\d{1,2})?', val.replace(',', ''))
-                if num_matches:
-                    numbers = [float(match.replace(',', '')) for match in num_matches]
-                    
-                    # Check if this might be a date disguised as numbers
-                    if len(numbers) == 3 and all(0 < num < 32 for num in numbers[:2]) and numbers[2] > 1900:
-                        results.append(val)
-                        continue
-                    
-                    largest_num = max(numbers, key=abs) if numbers else 0
-                    
-                    if abs(largest_num) > threshold:
-                        converted_num = largest_num / factor
-                        if converted_num.is_integer():
-                            converted_num = int(converted_num)
-                        else:
-                            converted_num = round(converted_num, 2)
-                        
-                        # Replace the largest number found
-                        new_val = val
-                        for num in sorted(numbers, key=lambda x: len(str(x)), reverse=True):
-                            if abs(num) > threshold:
-                                converted = num / factor
-                                if converted.is_integer():
-                                    converted = int(converted)
-                                else:
-                                    converted = round(converted, 2)
-                                new_val = new_val.replace(str(num), str(converted))
-                        results.append(new_val)
-                    else:
-                        results.append(val)
-                else:
-                    # Use Gemini only for complex cases with numbers
-                    if any(char.isdigit() for char in val) and api_key:
-                        numbers = cached_gemini_extraction(val, api_key)
-                        if numbers:
-                            largest_num = max(numbers, key=abs)
-                            if abs(largest_num) > threshold:
-                                converted_num = largest_num / factor
-                                converted_num = int(converted_num) if converted_num.is_integer() else round(converted_num, 2)
-                                results.append(str(converted_num))
-                            else:
-                                results.append(val)
-                        else:
-                            results.append(val)
-                    else:
-                        results.append(val)
-            else:
-                results.append(val)
-                
-        except Exception:
-            results.append(val)
+            return _SCALE_AMOUNT_RE.sub(replace, val)
+        if numbers and not amounts:
+            largest_num = max(numbers, key=abs)
+            if abs(largest_num) > threshold:
+                converted_num = largest_num / factor
+                converted_num = int(converted_num) if converted_num.is_integer() else round(converted_num, 2)
+                return str(converted_num)
+            return val
+    
+    new_val = _rewrite_numbers(val, factor, threshold)
+    return val if new_val is None else new_val
+
+def _safe_convert_text(val, factor, threshold, api_key=None, llm_numbers=None):
+    """_convert_text_value that leaves the cell untouched when a number fails to parse"""
+    # Gemini errors are handled in gemini_extract_batch; replay-mode misses must propagate
+    try:
+        return _convert_text_value(val, factor, threshold, api_key, llm_numbers)
+    except (ValueError, TypeError, OverflowError):
+        return val
+
+def process_cell_batch(cell_values, conversion_unit, threshold, api_key=None):
+    """Process a batch of cells efficiently; accepts a list or Series and returns a Series"""
+    factor = _FACTORS[conversion_unit]
+    
+    s = cell_values if isinstance(cell_values, pd.Series) else pd.Series(cell_values, dtype=object)
+    results = s.astype(object)
+    if s.empty:
+        return results
+    
+    # Classify by type in one pass: map the builtin type() over the cells, then
+    # test only the handful of distinct types (subclasses such as np.float64 included)
+    kinds = s.map(type)
+    distinct = kinds.unique()
+    number_types = [t for t in distinct if issubclass(t, (int, float)) and not issubclass(t, bool)]
+    text_types = [t for t in distinct if issubclass(t, str)]
+    is_number = kinds.isin(number_types).to_numpy(dtype=bool)
+    is_text = kinds.isin(text_types).to_numpy(dtype=bool)
+    
+    # Plain int/float cells: one masked division, no regex at all
+    if is_number.any():
+        nums = s[is_number].to_numpy(dtype=float)
+        with np.errstate(invalid='ignore'):
+            conv_mask = np.abs(nums) > threshold
+        if conv_mask.any():
+            positions = np.flatnonzero(is_number)[conv_mask]
+            results.iloc[positions] = _scale_values(nums[conv_mask], factor)
+    
+    # Text cells: labels, dates and repeated figures recur across rows, so each
+    # distinct string is classified and converted once
+    if is_text.any():
+        texts = s[is_text].tolist()
+        convertible = [val for val in dict.fromkeys(texts) if not is_non_monetary_content(val)]
+        if convertible:
+            # Strings the regex cannot read go to Gemini together, one request per distinct text
+            llm_numbers = gemini_extract_batch(convertible, api_key) if api_key else None
+            converted = {val: _safe_convert_text(val, factor, threshold, api_key, llm_numbers) for val in convertible}
+            results.iloc[np.flatnonzero(is_text)] = [converted.get(val, val) for val in texts]
     
     return results
 
 def convert_units_in_cell(val, conversion_unit="Lakhs", threshold=20, api_key=None):
     """Optimized single cell conversion"""
-    conversion_factors = {
-        "Hundred": 100,
-        "Thousand": 1000,
-        "Lakhs": 100000,
-        "Crore": 10000000
-    }
-    factor = conversion_factors[conversion_unit]
+    return _convert_cell(val, _FACTORS[conversion_unit], threshold)
+
+def _convert_cell(val, factor, threshold):
+    """Single cell conversion against an already resolved factor"""
+    # Text without any digit (labels, headings) has nothing to convert
+    if isinstance(val, str) and not _HAS_DIGIT_RE.search(val):
+        return val
     
     try:
-        # Skip processing for non-monetary content
-        if isinstance(val, str) and is_non_monetary_content(val):
-            return val
+        # Skip processing for non-monetary content; short whole-cell years, dates and
+        # day/month names are settled by a single combined match. Digit-grouped plain
+        # numbers (1,50,000) can never be dates, years or IDs, so they skip the checks
+        if isinstance(val, str) and not (',' in val and _PLAIN_NUMBER_RE.fullmatch(val)):
+            if (len(val) <= _EXCLUDE_MAX_LEN and _EXCLUDE_RE.fullmatch(val)) or is_non_monetary_content(val):
+                return val
         
         # Handle numeric values
         if isinstance(val, (int, float)):
@@ -257,137 +481,679 @@ def convert_units_in_cell(val, conversion_unit="Lakhs", threshold=20, api_key=No
         
         # Handle string values
         if isinstance(val, str):
-            # Quick regex extraction
-            num_matches = re.findall(r'-?\d{1,3}(?:,\d{3})*(?:\.\d{1,2})?', val.replace(',', ''))
-            if num_matches:
-                numbers = [float(match.replace(',', '')) for match in num_matches]
-                
-                # Check if this might be a date
-                if len(numbers) == 3 and all(0 < num < 32 for num in numbers[:2]) and numbers[2] > 1900:
-                    return val
-                
-                largest_num = max(numbers, key=abs) if numbers else 0
-                
-                if abs(largest_num) > threshold:
-                    # Replace all convertible numbers
-                    new_val = val
-                    for num in sorted(numbers, key=lambda x: len(str(x)), reverse=True):
-                        if abs(num) > threshold:
-                            converted = num / factor
-                            if converted.is_integer():
-                                converted = int(converted)
-                            else:
-                                converted = round(converted, 2)
-                            new_val = new_val.replace(str(num), str(converted))
-                    return new_val
-            return val
+            new_val = _rewrite_numbers(val, factor, threshold)
+            return val if new_val is None else new_val
         
         return val
-    except Exception:
+    except (ValueError, TypeError, OverflowError):
         return val
 
+def _scale_values(nums, factor):
+    """Divide a float array by factor; whole results become ints, the rest are rounded to 2 places"""
+    scaled = nums / factor
+    out = np.empty(scaled.shape, dtype=object)
+    # Whole values outside the int64 range fall through to the Python branch below
+    with np.errstate(invalid='ignore'):
+        is_int = (np.abs(scaled) < 2.0 ** 63) & (scaled == np.trunc(scaled))
+    if is_int.any():
+        out[is_int] = scaled[is_int].astype(np.int64).astype(object)
+    # np.round scales by 100 first and can land on the other side of a half
+    # (1500.005); builtin round keeps results identical to the per-cell path
+    if not is_int.all():
+        out[~is_int] = [int(x) if x.is_integer() else round(x, 2) for x in scaled[~is_int].tolist()]
+    return out
+
+def convert_df_vectorized(df, conversion_unit, threshold=20, api_key=None):
+    """Column-wise conversion: excluded cells are settled in bulk, the rest go through process_cell_batch as one batch"""
+    # to_numpy hands back a read-only view under copy-on-write, so this is the one copy made
+    values = df.to_numpy(dtype=object, copy=True)
+    residual = np.ones(values.shape, dtype=bool)
+    
+    for idx, col in enumerate(df.columns):
+        s = df[col]
+        
+        # Table cells are text; anything else is left to process_cell_batch
+        if not (pd.api.types.is_object_dtype(s) or pd.api.types.is_string_dtype(s)):
+            continue
+        
+        # Whole-cell years, dates and day/month names are left as they are in one pass
+        excl_mask = s.str.strip().str.fullmatch(_EXCLUDE_RE, na=False).astype(bool)
+        residual[:, idx] = ~excl_mask.to_numpy()
+    
+    # Every other cell, numbers included, takes the per-cell path (incl. Gemini) so PDF
+    # and Excel text convert alike; gathered across the whole table so it runs as one
+    # batch, and empty cells never enter it
+    residual &= pd.notna(values)
+    if residual.any():
+        processed = np.empty(residual.sum(), dtype=object)
+        processed[:] = process_cell_batch(values[residual], conversion_unit, threshold, api_key).to_numpy()
+        values[residual] = processed
+    
+    # values is private to this call; let the frame wrap it rather than copy it again
+    return pd.DataFrame(values, index=df.index, columns=df.columns, copy=False)
+
 def add_unit_row(df, conversion_unit):
     """Add an extra first row showing units only for columns with converted numeric values."""
-    unit_row = []
-    for col in df.columns:
-        # Sample first few rows to check for numeric values
-        sample_values = df[col].head(10).dropna()
-        has_converted = any(
-            isinstance(val, (int, float)) and abs(val) < 1000 and val == round(val, 2)
-            for val in sample_values
-        )
-        unit_row.append(f"(in {conversion_unit})" if has_converted else "")
+    # Sample first few rows; only real numbers (not numeric-looking text) count
+    sample = df.head(10).to_numpy(dtype=object)
+    is_number = np.vectorize(lambda val: isinstance(val, (int, float)), otypes=[bool])(sample)
+    nums = np.where(is_number, sample, np.nan).astype(float)
+    with np.errstate(invalid='ignore'):
+        has_converted = ((np.abs(nums) < 1000) & (nums == np.round(nums, 2))).any(axis=0)
+    unit_row = [f"(in {conversion_unit})" if flag else "" for flag in has_converted]
     
-    df_with_units = pd.DataFrame([unit_row], columns=df.columns)
-    df_with_units = pd.concat([df_with_units, df], ignore_index=True)
-    return df_with_units
+    # Build the labelled table in one allocation instead of a one-row frame plus concat
+    values = np.empty((len(df) + 1, len(df.columns)), dtype=object)
+    values[0] = unit_row
+    values[1:] = df.to_numpy(dtype=object)
+    return pd.DataFrame(values, columns=df.columns, copy=False)
 
-def extract_tables_from_pdf(file_bytes, conversion_unit, api_key=None):
-    """Optimized PDF table extraction"""
-    all_tables = {}
+class ProgressTicker:
+    """Forward progress to the Streamlit bar only every _PROGRESS_STEP or _PROGRESS_INTERVAL seconds"""
+    
+    def __init__(self):
+        self.next_tick = 0.0
+        self.last_time = time.monotonic()
+    
+    def update(self, fraction, message):
+        now = time.monotonic()
+        if fraction >= self.next_tick or now - self.last_time > _PROGRESS_INTERVAL:
+            st.session_state.progress_bar.progress(min(fraction, 1.0))
+            st.session_state.status_text.text(message)
+            self.next_tick = fraction + _PROGRESS_STEP
+            self.last_time = now
+
+class PdfWorkers:
+    """The pdf_worker.py processes of one parse, killed together when the parse is abandoned"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.procs = []
+        self.stopped = False
+    
+    def extract(self, pdf_path, page_indices):
+        """Raw tables for each page index, parsed by pdf_worker.py in a separate interpreter"""
+        # Started with exec, never fork: forking the threaded server can deadlock the child
+        with self.lock:
+            if self.stopped:
+                raise subprocess.SubprocessError("PDF parsing was stopped")
+            proc = subprocess.Popen(
+                [sys.executable, _PDF_WORKER, pdf_path, *map(str, page_indices)],
+                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            )
+            self.procs.append(proc)
+        try:
+            stdout, stderr = proc.communicate(timeout=_PDF_WORKER_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+            proc.communicate()
+            raise
+        if proc.returncode:
+            raise subprocess.CalledProcessError(proc.returncode, proc.args, stdout, stderr)
+        return json.loads(stdout)
+    
+    def kill(self):
+        """Stop every running worker and refuse to start new ones"""
+        with self.lock:
+            self.stopped = True
+            for proc in self.procs:
+                if proc.poll() is None:
+                    proc.kill()
+
+@st.cache_resource
+def _pdfium_lock():
+    """Process-wide PDFium lock; cached as a resource so every session and rerun shares it"""
+    # PDFium is not thread-safe and Streamlit sessions are threads of one process
+    return threading.Lock()
+
+def _pages_without_text(pdf_bytes):
+    """Indices of pages with no text layer, found with PDFium; empty when it is unavailable"""
+    if pdfium is None or pdf_bytes is None:
+        return frozenset()
+    with _pdfium_lock():
+        try:
+            doc = pdfium.PdfDocument(pdf_bytes)
+        except Exception as e:
+            print(f"PDFium could not open the PDF, parsing every page: {e}")
+            return frozenset()
+        try:
+            empty = set()
+            for i in range(len(doc)):
+                page = doc[i]
+                textpage = page.get_textpage()
+                if textpage.count_chars() == 0:
+                    empty.add(i)
+                textpage.close()
+                page.close()
+            return frozenset(empty)
+        finally:
+            doc.close()
+
+@st.cache_resource
+def _pymupdf_lock():
+    """Process-wide MuPDF lock; cached as a resource so every session and rerun shares it"""
+    # PyMuPDF is not thread-safe either, so no two sessions may call into it at once
+    return threading.Lock()
+
+def _iter_page_tables_pymupdf(pdf_bytes):
+    """PyMuPDF's table finder per page; pdfplumber only for text pages where it finds nothing"""
+    lock = _pymupdf_lock()
+    # The lock is held per call, never across a yield, so other sessions are only
+    # held up for one page at a time
+    with lock:
+        doc = pymupdf.open(stream=pdf_bytes, filetype="pdf")
+        total_pages = doc.page_count
+    try:
+        with pdfplumber.open(BytesIO(pdf_bytes)) as pdf:
+            for i in range(total_pages):
+                with lock:
+                    page = doc[i]
+                    tables = [table.extract() for table in page.find_tables().tables]
+                    has_text = bool(tables) or bool(page.get_text().strip())
+                    del page
+                if not tables and has_text:
+                    plumber_page = pdf.pages[i]
+                    tables = plumber_page.extract_tables()
+                    plumber_page.close()
+                yield i, total_pages, tables
+    finally:
+        with lock:
+            doc.close()
+
+def _pdf_cache_path(pdf_bytes):
+    """Cache file for a PDF; the table finder is part of the key since engines split cells differently"""
+    engine = 'pymupdf' if pymupdf is not None else 'pdfplumber'
+    return os.path.join(_PDF_CACHE_DIR, f"{hashlib.sha256(pdf_bytes).hexdigest()}-{engine}.jsonl.gz")
+
+def _read_pdf_cache(path):
+    """Stored pages for a cache entry, or None; unreadable entries are deleted so they get reparsed"""
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            pages = [tuple(json.loads(line)) for line in f]
+    except FileNotFoundError:
+        return None
+    except (OSError, EOFError, zlib.error, ValueError, TypeError) as e:
+        print(f"PDF cache error: {e}")
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        return None
+    # Hits count as use, so the age and size limits evict the least recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+    return pages
+
+def _prune_pdf_cache():
+    """Drop entries past _PDF_CACHE_MAX_AGE, then the oldest until the cache fits _PDF_CACHE_MAX_BYTES"""
+    try:
+        entries = []
+        now = time.time()
+        for entry in os.scandir(_PDF_CACHE_DIR):
+            stat = entry.stat()
+            # Leftover temp files from crashed runs age out the same way
+            if now - stat.st_mtime > _PDF_CACHE_MAX_AGE:
+                os.unlink(entry.path)
+            elif entry.name.endswith('.jsonl.gz'):
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= _PDF_CACHE_MAX_BYTES:
+                break
+            os.unlink(path)
+            total -= size
+    except OSError as e:
+        # Another session may be pruning at the same time
+        print(f"PDF cache error: {e}")
+
+def _discard_cache_file(out, raw, tmp_path):
+    """Close and remove a temp cache file that will not become an entry"""
+    for f in (out, raw):
+        try:
+            f.close()
+        except OSError:
+            pass
+    try:
+        os.unlink(tmp_path)
+    except OSError:
+        pass
+
+def _iter_page_tables(file_bytes):
+    """Yield (page_index, total_pages, raw tables) in page order, from the disk cache when the PDF was seen before"""
+    pdf_bytes = file_bytes.getvalue() if hasattr(file_bytes, "getvalue") else None
+    if pdf_bytes is None or not _PDF_CACHE_DIR:
+        yield from _parse_page_tables(file_bytes)
+        return
+    
+    path = _pdf_cache_path(pdf_bytes)
+    pages = _read_pdf_cache(path)
+    if pages is not None:
+        yield from pages
+        return
+    
+    # One JSON line per page, written as pages arrive to a temp file of this run's own
+    # (sessions are threads of one process); it only takes the entry's name, synced,
+    # once every page is in, so an interrupted run leaves nothing behind
+    raw = out = None
+    try:
+        os.makedirs(_PDF_CACHE_DIR, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=_PDF_CACHE_DIR)
+        raw = os.fdopen(fd, 'wb')
+        out = gzip.open(raw, 'wt', encoding='utf-8')
+    except OSError as e:
+        print(f"PDF cache error: {e}")
+        if raw is not None:
+            raw.close()
+            os.unlink(tmp_path)
+            raw = None
+    complete = False
+    try:
+        for page in _parse_page_tables(file_bytes):
+            if raw is not None:
+                try:
+                    out.write(json.dumps(page) + '\n')
+                except OSError as e:
+                    print(f"PDF cache error: {e}")
+                    _discard_cache_file(out, raw, tmp_path)
+                    raw = None
+            yield page
+        complete = True
+    finally:
+        if raw is not None:
+            if complete:
+                try:
+                    out.close()
+                    raw.flush()
+                    os.fsync(raw.fileno())
+                    raw.close()
+                    os.replace(tmp_path, path)
+                except OSError as e:
+                    print(f"PDF cache error: {e}")
+                    _discard_cache_file(out, raw, tmp_path)
+                else:
+                    _prune_pdf_cache()
+            else:
+                _discard_cache_file(out, raw, tmp_path)
+
+def _parse_page_tables(file_bytes):
+    """Yield (page_index, total_pages, raw tables) in page order, parsing pages in parallel when worthwhile"""
+    pdf_bytes = file_bytes.getvalue() if hasattr(file_bytes, "getvalue") else None
+    if pymupdf is not None and pdf_bytes is not None:
+        yield from _iter_page_tables_pymupdf(pdf_bytes)
+        return
     
-    with pdfplumber.open(file_bytes) as pdf:
+    # One pdfplumber document serves the page count and the sequential path
+    with pdfplumber.open(BytesIO(pdf_bytes) if pdf_bytes is not None else file_bytes) as pdf:
         total_pages = len(pdf.pages)
+        # Pages without any text (scans) cannot yield table cells and are passed over
+        skip = _pages_without_text(pdf_bytes)
+        parse_pages = [i for i in range(total_pages) if i not in skip]
+        
+        next_page = 0
+        workers = min(_PDF_WORKERS, len(parse_pages))
+        # pdfminer is pure Python, so only processes help; threads here just wait on them
+        if pdf_bytes is not None and workers > 1 and len(parse_pages) >= _PDF_PARALLEL_MIN_PAGES:
+            # Each chunk pays one interpreter start-up, so none is smaller than the parallel minimum
+            chunk_size = max(-(-len(parse_pages) // (workers * 4)), _PDF_PARALLEL_MIN_PAGES)
+            chunks = [parse_pages[start:start + chunk_size] for start in range(0, len(parse_pages), chunk_size)]
+            # Workers read the PDF from one temp file rather than each task pickling the bytes
+            pdf_file = tempfile.NamedTemporaryFile(suffix=".pdf", delete=False)
+            pdf_workers = PdfWorkers()
+            executor = ThreadPoolExecutor(max_workers=workers)
+            try:
+                with pdf_file:
+                    pdf_file.write(pdf_bytes)
+                futures = {executor.submit(pdf_workers.extract, pdf_file.name, chunk): n for n, chunk in enumerate(chunks)}
+                # Chunks finish in any order; each is handed on as soon as every
+                # chunk before it is done, so converting overlaps with parsing
+                done = {}
+                next_chunk = 0
+                for future in as_completed(futures):
+                    done[futures[future]] = future.result()
+                    while next_chunk in done:
+                        for i, tables in zip(chunks[next_chunk], done.pop(next_chunk)):
+                            for j in range(next_page, i):
+                                yield j, total_pages, []
+                            yield i, total_pages, tables
+                            next_page = i + 1
+                        next_chunk += 1
+            except (OSError, subprocess.SubprocessError, ValueError) as e:
+                print(f"Parallel PDF parsing failed, continuing sequentially: {e}")
+            else:
+                for j in range(next_page, total_pages):
+                    yield j, total_pages, []
+                return
+            finally:
+                # A rerun, a stop or a failed chunk closes the parse early: kill what is
+                # still running rather than wait for it
+                pdf_workers.kill()
+                executor.shutdown(wait=False, cancel_futures=True)
+                os.unlink(pdf_file.name)
         
-        for i, page in enumerate(pdf.pages):
+        # Sequential path (and fallback), resuming after any pages already produced
+        for i in range(next_page, total_pages):
+            if i in skip:
+                yield i, total_pages, []
+                continue
+            page = pdf.pages[i]
             tables = page.extract_tables()
-            if tables:
-                for j, table in enumerate(tables):
-                    df = pd.DataFrame(table)
-                    
-                    # Process entire DataFrame at once
-                    for col in df.columns:
-                        df[col] = process_cell_batch(df[col].tolist(), conversion_unit, 20, api_key)
-                    
-                    df = add_unit_row(df, conversion_unit)
-                    all_tables[f"Page_{i+1}_Table_{j+1}"] = df
-            
-            # Update progress
-            progress = (i + 1) / total_pages
-            st.session_state.progress_bar.progress(progress)
-            st.session_state.status_text.text(f"Processing PDF page {i+1}/{total_pages}")
+            # Release pdfplumber's per-page object caches before moving on
+            page.close()
+            yield i, total_pages, tables
+
+def _convert_page_tables(tables, conversion_unit, api_key=None):
+    """Convert all tables of a page as one stacked frame; returns a DataFrame per table"""
+    if not tables:
+        return []
+    # Tables are stacked row-wise into one object grid (padded to the widest row),
+    # so the per-frame setup and the text batch run once per page
+    widths = [max((len(row) for row in table), default=0) for table in tables]
+    offsets = np.cumsum([len(table) for table in tables])
+    stacked = np.full((offsets[-1], max(widths)), None, dtype=object)
+    r = 0
+    for table in tables:
+        for row in table:
+            stacked[r, :len(row)] = row
+            r += 1
+    missing = np.equal(stacked, None)
+    
+    # Process entire page at once
+    converted = convert_df_vectorized(pd.DataFrame(stacked), conversion_unit, 20, api_key).to_numpy(dtype=object)
+    # An all-object frame hands back a read-only view, which needs its own copy first
+    if not converted.flags.writeable:
+        converted = converted.copy()
     
-    return all_tables
+    frames = []
+    for part, part_missing, width in zip(
+        np.split(converted, offsets[:-1]), np.split(missing, offsets[:-1]), widths
+    ):
+        part, part_missing = part[:, :width], part_missing[:, :width]
+        # Empty cells as pd.DataFrame(table) has them: NaN in a column holding text,
+        # None in one that is empty throughout
+        empty_column = part_missing.all(axis=0)
+        part[part_missing & ~empty_column] = np.nan
+        part[part_missing & empty_column] = None
+        frames.append(pd.DataFrame(part, copy=False))
+    return frames
+
+def iter_tables_from_pdf(file_bytes, conversion_unit, api_key=None):
+    """Yield (sheet_name, DataFrame) for each converted PDF table, one page at a time"""
+    ticker = ProgressTicker()
+    for i, total_pages, tables in _iter_page_tables(file_bytes):
+        for j, df in enumerate(_convert_page_tables(tables, conversion_unit, api_key)):
+            yield f"Page_{i+1}_Table_{j+1}", add_unit_row(df, conversion_unit)
+        
+        # Update progress
+        ticker.update((i + 1) / total_pages, f"Processing PDF page {i+1}/{total_pages}")
+
+def extract_tables_from_pdf(file_bytes, conversion_unit, api_key=None):
+    """Optimized PDF table extraction"""
+    return dict(iter_tables_from_pdf(file_bytes, conversion_unit, api_key))
+
+def stream_pdf_to_xlsx(file_bytes, xlsx_target, conversion_unit, api_key=None):
+    """Write every converted PDF table to xlsx_target (path or file object); returns capped previews"""
+    # Tables go straight into the workbook, so only the previews stay in memory.
+    # xlsxwriter's constant_memory mode flushes each row as soon as the next starts,
+    # so rows are written in order here rather than through pandas (which writes column-wise).
+    # Nothing is written when the PDF has no tables
+    workbook = None
+    previews = {}
+    for sheet_name, df in iter_tables_from_pdf(BytesIO(file_bytes), conversion_unit, api_key):
+        if workbook is None:
+            workbook = xlsxwriter.Workbook(xlsx_target, {'constant_memory': True, 'strings_to_urls': False})
+        worksheet = workbook.add_worksheet(sheet_name[:31])
+        # Missing values become blank cells; masked for the whole table at once
+        values = df.to_numpy(dtype=object)
+        missing = pd.isna(values)
+        if missing.any():
+            values = np.where(missing, None, values)
+        for row_idx, row in enumerate(values.tolist()):
+            worksheet.write_row(row_idx, 0, row)
+        previews[sheet_name] = df.head(_PREVIEW_MAX_ROWS)
+    if workbook is not None:
+        workbook.close()
+    return previews
+
+def _unit_row_labels(columns, conversion_unit):
+    """Unit label for every column (an iterable of value tuples) holding at least one number"""
+    return [
+        f"(in {conversion_unit})" if any(
+            isinstance(val, (int, float)) and not isinstance(val, bool)
+            for val in col_values
+        ) else ""
+        for col_values in columns
+    ]
+
+def create_plain_excel(excel_bytes, conversion_unit, api_key=None):
+    """Values-only Excel processing: read-only input, streamed output, no formatting kept"""
+    wb_src = openpyxl.load_workbook(BytesIO(excel_bytes), read_only=True)
+    wb_data = None
+    # Rows are written strictly in order, so xlsxwriter can flush each one as it goes
+    output = BytesIO()
+    wb_out = xlsxwriter.Workbook(output, {
+        'constant_memory': True,
+        'strings_to_urls': False,
+        'default_date_format': 'yyyy-mm-dd h:mm:ss',
+    })
+    
+    total_sheets = len(wb_src.worksheets)
+    ticker = ProgressTicker()
+    for sheet_idx, ws_src in enumerate(wb_src.worksheets):
+        rows = list(ws_src.iter_rows(values_only=True))
+        width = max((len(row) for row in rows), default=0)
+        
+        # One object grid per sheet; the non-empty cells are converted as a single
+        # masked batch and written back in bulk
+        grid = np.full((len(rows), width), None, dtype=object)
+        for r, row in enumerate(rows):
+            grid[r, :len(row)] = row
+        # The grid holds every value now; the row tuples would only double the footprint
+        del rows
+        present = np.not_equal(grid, None)
+        cell_values = grid[present]
+        
+        # Formulas are converted through their last cached result; the data_only
+        # workbook is only opened, and only streamed, as far as the sheets need it
+        positions = np.argwhere(present)
+        formula_index = {
+            tuple(positions[idx].tolist()): idx
+            for idx, val in enumerate(cell_values)
+            if isinstance(val, str) and val.startswith('=')
+        }
+        if formula_index:
+            if wb_data is None:
+                wb_data = openpyxl.load_workbook(BytesIO(excel_bytes), data_only=True, read_only=True)
+            last_row = max(r for r, _ in formula_index)
+            for r, data_values in enumerate(wb_data[ws_src.title].iter_rows(values_only=True)):
+                if r > last_row:
+                    break
+                for c, data_value in enumerate(data_values[:width]):
+                    idx = formula_index.get((r, c))
+                    if idx is not None and data_value is not None:
+                        cell_values[idx] = data_value
+        
+        # Process cells in batches
+        grid[present] = process_cell_batch(cell_values, conversion_unit, 20, api_key).to_numpy()
+        
+        # Unit row first (check first 100 rows), then the converted rows, each handed
+        # to the constant_memory writer as it is listed rather than as one nested list
+        ws_out = wb_out.add_worksheet(ws_src.title)
+        ws_out.write_row(0, 0, _unit_row_labels(grid[1:99].T.tolist(), conversion_unit))
+        for row_idx, row in enumerate(grid, start=1):
+            ws_out.write_row(row_idx, 0, row.tolist())
+        
+        ticker.update((sheet_idx + 1) / total_sheets, f"Processing sheet {sheet_idx + 1}/{total_sheets}")
+    
+    wb_src.close()
+    if wb_data is not None:
+        wb_data.close()
+    
+    wb_out.close()
+    output.seek(0)
+    return output
+
+def _convert_numeric_column(column_cells, factor, threshold):
+    """Scale a column of (cell, number) pairs in one NumPy pass, writing back only the scaled cells"""
+    nums = np.array([value for _, value in column_cells], dtype=float)
+    with np.errstate(invalid='ignore'):
+        conv_mask = np.abs(nums) > threshold
+    for pos, new_value in zip(np.flatnonzero(conv_mask), _scale_values(nums[conv_mask], factor)):
+        column_cells[pos][0].value = new_value
 
 def create_preserve_excel(excel_bytes, conversion_unit, api_key=None):
     """Optimized Excel processing"""
-    # Load workbook once for data
-    wb_data = openpyxl.load_workbook(BytesIO(excel_bytes), data_only=True)
+    # Full workbook for editing; cached formula results are only streamed from a
+    # read-only data_only pass for sheets that actually contain formulas
     wb = openpyxl.load_workbook(BytesIO(excel_bytes), data_only=False)
+    wb_data = None
+    factor = _FACTORS[conversion_unit]
     
     total_sheets = len(wb.sheetnames)
-    total_cells = sum(ws.max_row * ws.max_column for ws in wb_data.worksheets)
-    processed_cells = 0
+    total_rows = sum(ws.max_row for ws in wb.worksheets)
+    processed_rows = 0
+    ticker = ProgressTicker()
     
     for sheet_idx, ws_name in enumerate(wb.sheetnames):
-        ws_data = wb_data[ws_name]
         ws = wb[ws_name]
         
         # Collect all cell values for batch processing
         cell_values = []
-        cell_positions = []
+        cells = []
+        formula_index = {}
         
-        for row in range(1, ws.max_row + 1):
-            for col in range(1, ws.max_column + 1):
-                cell_data = ws_data.cell(row=row, column=col)
-                cell = ws.cell(row=row, column=col)
-                
-                if cell.value is not None:
-                    cell_values.append(cell_data.value if cell_data.value is not None else cell.value)
-                    cell_positions.append((row, col))
-                processed_cells += 1
-                
-                # Update progress periodically
-                if processed_cells % 100 == 0:
-                    progress = processed_cells / total_cells
-                    st.session_state.progress_bar.progress(progress)
-                    st.session_state.status_text.text(f"Processing cell {processed_cells}/{total_cells}")
+        for row_cells in ws.iter_rows():
+            for cell in row_cells:
+                if cell.value is None:
+                    continue
+                if cell.data_type == 'f':
+                    formula_index[(cell.row, cell.column)] = len(cells)
+                cell_values.append(cell.value)
+                cells.append(cell)
+            processed_rows += 1
+            ticker.update(processed_rows / total_rows, f"Processing row {processed_rows}/{total_rows}")
+        
+        # Formulas are converted through their last cached result, when there is one
+        if formula_index:
+            if wb_data is None:
+                wb_data = openpyxl.load_workbook(BytesIO(excel_bytes), data_only=True, read_only=True)
+            first_row = min(r for r, _ in formula_index)
+            last_row = max(r for r, _ in formula_index)
+            data_rows = wb_data[ws_name].iter_rows(
+                min_row=first_row, max_row=last_row, max_col=ws.max_column, values_only=True
+            )
+            for r, data_values in enumerate(data_rows, start=first_row):
+                for c, data_value in enumerate(data_values, start=1):
+                    idx = formula_index.get((r, c))
+                    if idx is not None and data_value is not None:
+                        cell_values[idx] = data_value
+            # Every formula is replaced by its cached result, whether or not the
+            # conversion below changes that result
+            for idx in formula_index.values():
+                cells[idx].value = cell_values[idx]
+        
+        # Numbers skip the classifier and are scaled with NumPy one column at a
+        # time (a header label doesn't demote the column); text goes to the batch path
+        numeric_columns = {}
+        batch_cells = []
+        batch_values = []
+        for cell, value in zip(cells, cell_values):
+            if type(value) in (int, float):
+                numeric_columns.setdefault(cell.column, []).append((cell, value))
+            else:
+                batch_cells.append(cell)
+                batch_values.append(value)
+        for column_cells in numeric_columns.values():
+            _convert_numeric_column(column_cells, factor, 20)
         
         # Process cells in batches
-        processed_values = process_cell_batch(cell_values, conversion_unit, 20, api_key)
+        processed_values = process_cell_batch(batch_values, conversion_unit, 20, api_key)
         
         # Update cells with processed values
-        for (row, col), new_value in zip(cell_positions, processed_values):
-            ws.cell(row=row, column=col).value = new_value
+        for cell, new_value in zip(batch_cells, processed_values):
+            cell.value = new_value
         
-        # Add unit row
-        unit_row = []
-        for col in range(1, ws.max_column + 1):
-            has_numeric = any(
-                isinstance(ws.cell(row=row, column=col).value, (int, float))
-                for row in range(2, min(ws.max_row + 1, 100))  # Check first 100 rows
-            )
-            unit_row.append(f"(in {conversion_unit})" if has_numeric else "")
+        # Add unit row (check first 100 rows); numbers keep their type through the
+        # conversion, so the numeric cells collected above already tell which columns qualify
+        labelled = {
+            column for column, column_cells in numeric_columns.items()
+            if any(2 <= cell.row <= 99 for cell, _ in column_cells)
+        }
+        unit_row = [f"(in {conversion_unit})" if column in labelled else "" for column in range(1, ws.max_column + 1)]
         
         ws.insert_rows(1)
         for idx, val in enumerate(unit_row, start=1):
             ws.cell(row=1, column=idx).value = val
     
+    if wb_data is not None:
+        wb_data.close()
+    
     output = BytesIO()
     wb.save(output)
     output.seek(0)
     return output
 
+def _start_progress():
+    st.session_state.progress_bar = st.progress(0)
+    st.session_state.status_text = st.empty()
+
+def _finish_progress(message):
+    st.session_state.progress_bar.progress(1.0)
+    st.session_state.status_text.text(message)
+    time.sleep(0.5)
+    st.session_state.progress_bar.empty()
+    st.session_state.status_text.empty()
+
+# Cache whole-file conversions so widget reruns on the same upload and options skip reprocessing.
+# Progress elements are created inside so that Streamlit can replay them on a cache hit.
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def convert_excel_cached(file_bytes, conversion_unit, preserve_formatting=True, api_key=None):
+    """Convert an uploaded workbook and return the resulting xlsx bytes"""
+    _start_progress()
+    if preserve_formatting:
+        output = create_preserve_excel(file_bytes, conversion_unit, api_key)
+    else:
+        output = create_plain_excel(file_bytes, conversion_unit, api_key)
+    _finish_progress("Conversion complete!")
+    return output.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def convert_pdf_cached(file_bytes, conversion_unit, api_key=None):
+    """Convert PDF tables; returns (previews by sheet name, xlsx bytes or None)"""
+    _start_progress()
+    output = BytesIO()
+    previews = stream_pdf_to_xlsx(file_bytes, output, conversion_unit, api_key)
+    _finish_progress("Processing completed!")
+    return previews, output.getvalue() if previews else None
+
+def _read_excel(data, **kwargs):
+    """pd.read_excel through calamine (.xlsx and .xls alike) when installed, else pandas' default reader"""
+    if _EXCEL_READ_ENGINE is not None:
+        try:
+            return pd.read_excel(BytesIO(data), engine=_EXCEL_READ_ENGINE, **kwargs)
+        except Exception as e:
+            # A workbook calamine rejects may still open with openpyxl/xlrd
+            print(f"calamine could not read the workbook, using the default reader: {e}")
+    return pd.read_excel(BytesIO(data), **kwargs)
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def read_excel_preview(file_bytes, nrows=6):
+    """First rows of the uploaded workbook's first sheet"""
+    return _read_excel(file_bytes, nrows=nrows)
+
+@st.cache_data(show_spinner=False, max_entries=_CACHE_MAX_ENTRIES)
+def summarize_converted_excel(xlsx_bytes):
+    """(capped preview, column count, row count, numeric column count) of the converted workbook"""
+    converted_df = _read_excel(xlsx_bytes)
+    # Typed numeric (and bool) columns count as they are; only mixed object columns need
+    # parsing, while datetime, text and other typed columns never count
+    typed = converted_df.select_dtypes(include=['number', 'bool'])
+    mixed = converted_df.select_dtypes(include='object')
+    numeric_cols = int(typed.notna().any().sum()) + int(
+        mixed.apply(pd.to_numeric, errors='coerce').notna().any().sum()
+    )
+    return converted_df.head(_PREVIEW_MAX_ROWS), len(converted_df.columns), len(converted_df), numeric_cols
+
 # Streamlit UI
 st.set_page_config(page_title="Balance Sheet Converter", layout="wide")
 st.title("📊 Balance Sheet Converter with Gemini 2.0 Flash")
@@ -416,6 +1182,12 @@ if api_key:
 else:
     st.sidebar.warning("Add a Gemini API key for enhanced conversion (optional)")
 
+replay_mode = st.sidebar.checkbox(
+    "Replay mode (use stored Gemini responses only, fail on a miss)",
+    value=False
+)
+gemini_disk_cache.mode = 'replay' if replay_mode else 'enabled'
+
 st.sidebar.info("""
 This tool converts monetary values in balance sheets while preserving:
 - Dates and time periods (2025, 31.03.2025, etc.)
@@ -439,50 +1211,52 @@ threshold = st.slider(
     value=20
 )
 
+preserve_formatting = st.checkbox(
+    "Preserve Excel formatting (uncheck for faster, values-only output on large workbooks)",
+    value=True
+)
+
 uploaded_file = st.file_uploader("Choose an Excel or PDF file", type=["xlsx", "xls", "pdf"])
 
 if uploaded_file is not None:
     file_type = uploaded_file.name.split('.')[-1].lower()
-    file_bytes = uploaded_file.read()
+    file_bytes = uploaded_file.getvalue()
 
     if file_type in ["xlsx", "xls"]:
         st.success(f"Processing Excel file: {uploaded_file.name}")
 
         # Show original preview
         try:
-            original_df = pd.read_excel(BytesIO(file_bytes))
+            original_df = read_excel_preview(file_bytes)
             st.subheader("Original Values Preview")
-            st.dataframe(original_df.head(6))
+            st.dataframe(original_df)
         except Exception as e:
             st.warning(f"Could not display original file preview: {e}")
 
         # Process file
-        st.session_state.progress_bar = st.progress(0)
-        st.session_state.status_text = st.empty()
-        
-        excel_output = create_preserve_excel(file_bytes, conversion_unit, api_key if use_gemini else None)
-        
-        st.session_state.progress_bar.progress(1.0)
-        st.session_state.status_text.text("Conversion complete!")
-        time.sleep(0.5)
-        st.session_state.progress_bar.empty()
-        st.session_state.status_text.empty()
+        try:
+            # The cached bytes feed both the summary and the download, without a second copy
+            excel_output = convert_excel_cached(
+                file_bytes, conversion_unit, preserve_formatting, api_key if use_gemini else None
+            )
+        except GeminiCacheMiss as e:
+            st.error(f"Replay mode: no stored Gemini response for {str(e)!r}")
+            st.stop()
 
         # Show converted preview
         try:
-            converted_df = pd.read_excel(excel_output)
+            preview_df, n_cols, n_rows, numeric_cols = summarize_converted_excel(excel_output)
             st.subheader("Converted Values Preview")
-            st.dataframe(converted_df.head(6))
+            show_more = st.checkbox(f"Show up to {_PREVIEW_MAX_ROWS} rows", key="excel_show_more")
+            st.dataframe(preview_df if show_more else preview_df.head(6))
             
             # Statistics
             col1, col2, col3 = st.columns(3)
             with col1:
-                st.metric("Columns", len(converted_df.columns))
+                st.metric("Columns", n_cols)
             with col2:
-                st.metric("Rows", len(converted_df))
+                st.metric("Rows", n_rows)
             with col3:
-                numeric_cols = sum([converted_df[col].apply(lambda x: isinstance(x, (int, float))).any() 
-                                  for col in converted_df.columns])
                 st.metric("Numeric Columns", numeric_cols)
                 
         except Exception as e:
@@ -500,37 +1274,26 @@ if uploaded_file is not None:
         st.success(f"Processing PDF file: {uploaded_file.name}")
         
         # Process PDF
-        st.session_state.progress_bar = st.progress(0)
-        st.session_state.status_text = st.empty()
-        
-        tables_dict = extract_tables_from_pdf(BytesIO(file_bytes), conversion_unit, api_key if use_gemini else None)
-        
-        st.session_state.progress_bar.progress(1.0)
-        st.session_state.status_text.text("Processing completed!")
-        time.sleep(0.5)
-        st.session_state.progress_bar.empty()
-        st.session_state.status_text.empty()
-
-        if tables_dict:
-            st.write(f"**Found {len(tables_dict)} tables in the PDF**")
+        try:
+            previews, pdf_excel = convert_pdf_cached(file_bytes, conversion_unit, api_key if use_gemini else None)
+        except GeminiCacheMiss as e:
+            st.error(f"Replay mode: no stored Gemini response for {str(e)!r}")
+            st.stop()
+
+        if previews:
+            st.write(f"**Found {len(previews)} tables in the PDF**")
             
             # Navigation
-            table_names = list(tables_dict.keys())
+            table_names = list(previews.keys())
             selected_table = st.selectbox("Select table to view:", table_names)
             
             st.write(f"**{selected_table}**")
-            st.dataframe(tables_dict[selected_table].head(8))
-
-            # Create Excel output
-            output = BytesIO()
-            with pd.ExcelWriter(output, engine="openpyxl") as writer:
-                for sheet_name, df in tables_dict.items():
-                    df.to_excel(writer, sheet_name=sheet_name[:31], index=False, header=False)
-            output.seek(0)
+            show_more = st.checkbox(f"Show up to {_PREVIEW_MAX_ROWS} rows", key="pdf_show_more")
+            st.dataframe(previews[selected_table] if show_more else previews[selected_table].head(8))
 
             st.download_button(
                 label=f"📥 Download Excel",
-                data=output,
+                data=pdf_excel,
                 file_name=f"converted_{uploaded_file.name.split('.')[0]}.xlsx",
                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
             )